@@ -1,13 +1,16 @@
 import datetime
+import functools
 import calendar
+import os
 import sys
 import struct
 import mmap
+import operator
 from aenum import Enum,Flag
+import numpy as np
 from scipy.cluster.vq import kmeans2
-from scipy.stats import entropy
-from collections import Counter
-from hashlib import md5
+from hashlib import blake2b
+from concurrent.futures import ProcessPoolExecutor
 from zlib import crc32
 
 """
@@ -21,9 +24,140 @@ All the same, a safer score for filtering out false results would be 0.35. This
 pretty much does empty pages and very nearly empty pages.
 """
 def page_entropy(page_data):
-    ctr = Counter(page_data) # Do a count of values identified over a set
-    return entropy(ctr.values()) # Get the Shannon entropy for the distribution
-                                 # of resulting values found.
+    # Histogram the byte values in C rather than building a Counter dict
+    counts = np.bincount(np.frombuffer(page_data, dtype=np.uint8), minlength=256)
+    nz = counts[counts > 0].astype(np.float64)
+    p = nz / nz.sum()
+    return float(-(p * np.log(p)).sum()) # Shannon entropy of the distribution
+                                         # of resulting values found.
+
+EMPTY_PAGE_ENTROPY = 0.35
+
+_SIG_STRUCT = struct.Struct("<I")
+
+"""
+Find every offset in a buffer at which one of the given (little endian uint32)
+signatures starts, in order. The buffer is compared in blocks as NumPy arrays:
+"PK" pairs first, then the full four bytes at just those positions.
+
+:return: arrays of offsets and the signature found at each
+:rtype: tuple
+"""
+def find_signatures(data, sigs, block=1 << 24):
+    a = np.frombuffer(data, dtype=np.uint8)
+    wanted = np.array(sigs, dtype=np.uint32)
+    offsets = [np.zeros(0, dtype=np.int64)]
+    found = [np.zeros(0, dtype=np.uint32)]
+    for start in range(0, max(len(a) - 3, 0), block):
+        # Overlap the next block by 3 bytes so no signature is split
+        w = a[start:start + block + 3]
+        n = len(w) - 3
+        pos = np.flatnonzero((w[:n] == 0x50) & (w[1:n+1] == 0x4b))
+        vals = (w[pos].astype(np.uint32) |
+                w[pos+1].astype(np.uint32) << 8 |
+                w[pos+2].astype(np.uint32) << 16 |
+                w[pos+3].astype(np.uint32) << 24)
+        keep = np.isin(vals, wanted)
+        offsets.append(pos[keep] + start)
+        found.append(vals[keep])
+    return (np.concatenate(offsets), np.concatenate(found))
+
+"""
+The same score as page_entropy for every whole page of a buffer at once. Each
+page's byte values are offset into their own run of 256 bins so a block of
+pages is histogrammed by a single bincount.
+"""
+def page_entropies(data, pageSz, block=1024):
+    a = np.frombuffer(data, dtype=np.uint8)
+    n = len(a) // pageSz
+    out = np.empty(n, dtype=np.float64)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        rows = a[start*pageSz:stop*pageSz].reshape(stop - start, pageSz)
+        bins = rows + (np.arange(stop - start) * 256)[:, None]
+        counts = np.bincount(bins.ravel(), minlength=(stop - start) * 256)
+        p = counts.reshape(stop - start, 256) / float(pageSz)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[start:stop] = -np.where(p > 0, p * np.log(p), 0.0).sum(axis=1)
+    return out
+
+"""
+CRC32 is linear over GF(2), so the CRC of two concatenated blocks can be
+derived from the CRCs of each block and the length of the second (as zlib's
+crc32_combine does). Appending len2 zero bytes to a CRC is a fixed 32x32 bit
+matrix, built here by repeated squaring and cached per length, so combining
+per-page CRCs for a candidate page ordering never rehashes page data.
+
+Note the CRC32 recorded in zip headers is over the *uncompressed* data, so
+page CRCs can only be checked directly against stored (NoCompression) entries.
+"""
+def _gf2_matrix_times(mat, vec):
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+_CRC32_SHIFTS = {}
+
+def _crc32_shift_matrix(len2):
+    mat = _CRC32_SHIFTS.get(len2)
+    if mat is None:
+        # Operator for a single zero bit, squared up to a single zero byte
+        op = [0xedb88320] + [1 << n for n in range(31)]
+        for i in range(3):
+            op = _gf2_matrix_square(op)
+        mat = [1 << n for n in range(32)] # Identity
+        n = len2
+        while n:
+            if n & 1:
+                mat = [_gf2_matrix_times(op, row) for row in mat]
+            n >>= 1
+            if n:
+                op = _gf2_matrix_square(op)
+        _CRC32_SHIFTS[len2] = mat
+    return mat
+
+def crc32_combine(crc1, crc2, len2):
+    if len2 <= 0:
+        return crc1
+    return _gf2_matrix_times(_crc32_shift_matrix(len2), crc1) ^ crc2
+
+def _gf2_matrix_solve(mat, vec):
+    # The v for which _gf2_matrix_times(mat, v) == vec, by eliminating over
+    # the (invertible) matrix's columns, keyed by their highest set bit
+    pivots = {}
+    for (i, col) in enumerate(mat):
+        pre = 1 << i
+        while col:
+            top = col.bit_length() - 1
+            if not top in pivots:
+                pivots[top] = (col, pre)
+                break
+            (img, img_pre) = pivots[top]
+            col ^= img
+            pre ^= img_pre
+    v = 0
+    while vec:
+        (img, img_pre) = pivots[vec.bit_length() - 1]
+        vec ^= img
+        v ^= img_pre
+    return v
+
+"""
+crc32_combine solved for crc1: the CRC of the leading block which, followed
+by len2 bytes with CRC crc2, gives crc for the whole
+"""
+def crc32_uncombine(crc, crc2, len2):
+    if len2 <= 0:
+        return crc
+    return _gf2_matrix_solve(_crc32_shift_matrix(len2), crc ^ crc2)
 
 class Chunk(Enum):
     EOCD = b"PK\x05\x06"
@@ -48,6 +182,9 @@ class ZMethod(Enum):
     IBMLZ77z = 19
     PPMdV1R1 = 98
 
+# Recognised compression methods by value, for lookups without aenum calls
+_ZMETHODS = dict((zmeth.value, zmeth) for zmeth in ZMethod)
+
 class ZFlags(Flag):
     Encrypted = 0x1
     Opt1 = 0x2
@@ -62,11 +199,9 @@ class ZFlags(Flag):
     def check(self,flag):
         return flag in self
 
-def findPageIdxForPtr(slice_list, ptr):
-    for (idx,s) in enumerate(slice_list):
-        if s and ptr >= s.start and ptr < s.stop:
-            return idx
-    return None
+# Flag values in iteration order, for building signature matrix columns with
+# plain bitmask arithmetic rather than aenum membership tests
+_ZFLAG_VALUES = np.array([f.value for f in ZFlags], dtype=np.uint32)
 
 """
 An abstract model of an unknown fragmented file system
@@ -74,50 +209,70 @@ An abstract model of an unknown fragmented file system
 class FragSys:
     def __init__(self, path, pageSz):
         self.pageSz = pageSz
+        self._empty_page = b"\x00"*pageSz # Filler for missing pages
         self.data = None
-        self.fragments = []
+        self.frag_present = np.zeros(0, dtype=np.uint8)
+        self.page_crcs = None
+        self.page_crc_index = None
+        self._entropies = None
         self.zipFiles = []
         self.fileHeaders = []
         self.CDHeaders = []
 
         if not path==None:
-            with open(path) as f:
+            with open(path, 'rb') as f:
                 # mmap the file rather than just reading it into memory to avoid
                 # memory issues on larger files
                 self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-            self.fragments = [slice(x*self.pageSz, (x+1) * self.pageSz) for x in range(0,len(self.data)//pageSz)]
+                # Everything downstream sweeps the dump front to back, so ask
+                # for aggressive readahead where the platform supports it
+                try:
+                    self.data.madvise(mmap.MADV_SEQUENTIAL)
+                    self.data.madvise(mmap.MADV_WILLNEED)
+                except (AttributeError, OSError):
+                    pass
+                try:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except (AttributeError, OSError):
+                    pass
+            # One flag per whole page of the dump, cleared once the page has
+            # been claimed. Pages are referred to everywhere by index, so a
+            # page's index is always ptr // pageSz
+            self.frag_present = np.ones(len(self.data)//pageSz, dtype=np.uint8)
         # Otherwise initialise our own data map
 
-    def getChunks(self, chType):
-        cursor = 0
-        data = self.data
-        while True:
-            cursor = data.find(chType.value, cursor)
-            if cursor == -1:
-                break
-            else:
-                if chType == Chunk.EOCD:
-                    z = zipFile.from_data(data[cursor:])
-                    z.ptr = cursor
-                    if (self.pageSz - (cursor % self.pageSz) < 20):
-                        z.boundaryTaint = True
-
-                    (z.start_offset,z.pg_ct) = self.getStartOffset(z, cursor)
-                    z.fragments = [None for i in range(z.pg_ct)]
-                    self.zipFiles.append(z)
-                elif chType == Chunk.LFH:
-                    l = LFH.from_data(data[cursor:])
-                    l.ptr = cursor
-                    if (self.pageSz - (cursor % self.pageSz) < 30):
-                        l.boundaryTaint = True
-                    self.fileHeaders.append(l)
-                elif chType == Chunk.CD:
-                    c = CDH.from_data(data[cursor:])
-                    c.ptr = cursor
-                    if (self.pageSz - (cursor % self.pageSz) < 0x46):
-                        c.boundaryTaint = True
-                    self.CDHeaders.append(c)
-                cursor += 1
+    def getChunks(self, *chTypes):
+        # Locate every wanted signature in one vectorised sweep, so Python
+        # only runs per genuine header rather than per byte or "PK" pair
+        wanted = dict((_SIG_STRUCT.unpack(chType.value)[0], chType)
+                for chType in chTypes)
+        (offsets, sigs) = find_signatures(self.data, list(wanted))
+        # Headers are parsed from views into the map, as slicing the map
+        # itself would copy everything from the cursor to the end of the dump
+        mv = memoryview(self.data)
+        for (cursor, sig) in zip(offsets.tolist(), sigs.tolist()):
+            chType = wanted[sig]
+            if chType == Chunk.EOCD:
+                z = zipFile.from_data(mv[cursor:])
+                z.ptr = cursor
+                if (self.pageSz - (cursor % self.pageSz) < _EOCD_SIZE):
+                    z.boundaryTaint = True
+
+                (z.start_offset,z.pg_ct) = self.getStartOffset(z, cursor)
+                z.fragments = [None for i in range(z.pg_ct)]
+                self.zipFiles.append(z)
+            elif chType == Chunk.LFH:
+                l = LFH.from_data(mv[cursor:])
+                l.ptr = cursor
+                if (self.pageSz - (cursor % self.pageSz) < _LFH_SIZE):
+                    l.boundaryTaint = True
+                self.fileHeaders.append(l)
+            elif chType == Chunk.CD:
+                c = CDH.from_data(mv[cursor:])
+                c.ptr = cursor
+                if (self.pageSz - (cursor % self.pageSz) < _CDH_SIZE):
+                    c.boundaryTaint = True
+                self.CDHeaders.append(c)
 
     def getStartOffset(self, z, cursor):
         eocd_page_offset = cursor % self.pageSz
@@ -125,42 +280,168 @@ class FragSys:
         start_offset = self.pageSz - \
                 ((eocd_file_offset - eocd_page_offset) % self.pageSz)
         page_count = int(eocd_page_offset > 0) + int(start_offset > 0) +\
-               (eocd_file_offset - eocd_page_offset - start_offset) /  \
+               (eocd_file_offset - eocd_page_offset - start_offset) // \
                self.pageSz
-        return (start_offset,page_count)
+        return (start_offset,int(page_count))
 
-    def findEOCDs(self):
-        self.getChunks(Chunk.EOCD)
+    def findAll(self):
+        self.getChunks(Chunk.EOCD, Chunk.LFH, Chunk.CD)
 
-    def findLFHs(self):
-        self.getChunks(Chunk.LFH)
+    def findPageIdxForPtr(self, ptr):
+        idx = ptr // self.pageSz
+        if idx < len(self.frag_present) and self.frag_present[idx]:
+            return idx
+        return None
 
-    def findCDs(self):
-        self.getChunks(Chunk.CD)
+    def takePage(self, idx):
+        self.frag_present[idx] = 0
+        return idx
+
+    def pageSlice(self, idx):
+        return slice(idx*self.pageSz, (idx+1)*self.pageSz)
+
+    def pageEntropies(self):
+        # Entropy score per dump page, computed for the whole dump on first use
+        if self._entropies is None:
+            self._entropies = page_entropies(self.data, self.pageSz)
+        return self._entropies
+
+    def candidatePages(self):
+        # Unclaimed pages which aren't (nearly) empty, as candidates for
+        # filling gaps
+        return np.nonzero((self.frag_present > 0) &
+                (self.pageEntropies() >= EMPTY_PAGE_ENTROPY))[0]
+
+    def pageCRCs(self):
+        # One CRC32 per dump page, computed (in zlib) on first use
+        if self.page_crcs is None:
+            self.page_crcs = [crc32(self.data[self.pageSlice(i)]) & 0xffffffff
+                    for i in range(len(self.frag_present))]
+        return self.page_crcs
+
+    def pageCRCIndex(self):
+        # Dump page indices keyed by page CRC32, built on first use
+        if self.page_crc_index is None:
+            self.page_crc_index = {}
+            for (idx, page_crc) in enumerate(self.pageCRCs()):
+                self.page_crc_index.setdefault(page_crc, []).append(idx)
+        return self.page_crc_index
+
+    def pagesMatchingCRC(self, candidates, crc_before, crc_after, len_after,
+            crc):
+        # Candidate pages which, placed between data with the given CRCs, give
+        # the expected CRC for the whole run. Combining is linear, so solve
+        # for the one page CRC that does and look it up, rather than trying
+        # every candidate
+        page_crc = (crc32_uncombine(crc, crc_after, len_after) ^
+                crc32_combine(crc_before, 0, self.pageSz))
+        matches = np.array(self.pageCRCIndex().get(page_crc, []), dtype=np.intp)
+        return matches[np.isin(matches, candidates)].tolist()
+
+    def storedSpans(self, filedata, start_offset, cds):
+        # (start, end, crc32) of the data of each stored, unencrypted entry
+        # whose LFH is present in a rendered zip file, as offsets into it
+        mv = memoryview(filedata)
+        spans = []
+        for (_,cd) in cds:
+            if (cd.method != ZMethod.NoCompression or
+                    cd.flags & ZFlags.Encrypted.value):
+                continue
+            lfh_ptr = start_offset + cd.lf_offset
+            if bytes(mv[lfh_ptr:lfh_ptr+4]) != Chunk.LFH.value:
+                continue
+            l = LFH.from_data(mv[lfh_ptr:])
+            if l is None:
+                continue
+            start = lfh_ptr + _LFH_SIZE + l.fnLen + l.cmtLen
+            spans.append((start, start + cd.c_sz, cd.crc32))
+        return spans
+
+    def cdsInPages(self, pages):
+        # CD headers found within a run of pages (as assembled for a zip
+        # file's CD), as (offset into the rendered run, CDH) pairs in order.
+        # Records split across pages in the run are re-parsed from the pages
+        # they span, rather than rescanning the run.
+        ps = self.pageSz
+        order = dict((p, i) for (i,p) in enumerate(pages))
+        found = []
+        seen = set()
+        for c in self.CDHeaders:
+            pos = order.get(c.ptr // ps)
+            if pos is None:
+                continue
+            seen.add(c.ptr)
+            if c.ptr % ps + c.len > ps:
+                c = self.parseCDAcross(pages, pos, c.ptr % ps, c.ptr)
+            if c is not None:
+                found.append((pos * ps + c.ptr % ps, c))
+        # Signatures which are themselves split across a page boundary (unless
+        # the scan already happened upon the same bytes in the dump)
+        sig_len = len(Chunk.CD.value)
+        for i in range(len(pages) - 1):
+            (end, start) = ((pages[i]+1) * ps, pages[i+1] * ps)
+            window = (self.data[end-sig_len+1:end] +
+                    self.data[start:start+sig_len-1])
+            split = window.find(Chunk.CD.value)
+            offs = ps - sig_len + 1 + split
+            if split != -1 and not pages[i] * ps + offs in seen:
+                c = self.parseCDAcross(pages, i, offs, pages[i] * ps + offs)
+                if c is not None:
+                    found.append((i * ps + offs, c))
+        found.sort(key=operator.itemgetter(0))
+        return found
+
+    def parseCDAcross(self, pages, pos, offs, ptr):
+        # Parse from as many pages of the run as the record spans. Its length
+        # is only known once the fixed fields are parsed, and they may be
+        # split themselves, so start with two pages and re-parse if needed
+        ps = self.pageSz
+        count = 2
+        while True:
+            c = CDH.from_data(
+                    memoryview(self.renderFragList(pages[pos:pos+count]))[offs:])
+            if c is None:
+                return None
+            needed = (offs + c.len + ps - 1) // ps
+            if needed <= count or pos + count >= len(pages):
+                break
+            count = needed
+        c.ptr = ptr
+        return c
+
+    def indexLFHs(self):
+        # Key every discovered LFH by its raw header bytes, which is exactly
+        # what CDH.to_LFH reconstructs, so each CD can look up its LFH
+        # candidates directly instead of re-searching the whole dump
+        index = {}
+        for l in self.fileHeaders:
+            index.setdefault(self.data[l.ptr:l.ptr+_LFH_SIZE+l.fnLen], []).append(l.ptr)
+        return index
 
     def classifyChunks(self, chType):
         if chType == Chunk.LFH:
-            chunks = [i for i in self.fileHeaders]
+            (cls, chunks) = (LFH, self.fileHeaders)
         elif chType == Chunk.CD:
-            chunks = [i for i in self.CDHeaders]
+            (cls, chunks) = (CDH, self.CDHeaders)
 
         number = len(self.zipFiles)
 
         # Eliminate chunks with invalid datetime.
         chunks = [c for c in chunks if not c.last_mod_datetime == None]
 
-        centroids,classes = kmeans2([i.sig_vector() for i in chunks], number, minit='points')
+        centroids,classes = kmeans2(cls.sig_matrix(chunks), number, minit='++')
         silos = [[j[1] for j in zip(classes,chunks) if j[0]==i] for i in range(number)]
-        return zip(silos,centroids)
+        return list(zip(silos,centroids))
 
     def renderFragList(self, fragments):
-        data = b""
-        for f in fragments:
-            if f is None:
-                data += "\x00"*self.pageSz
-            else:
-                data += self.data[f]
-        return data
+        # Copy each page into place in a single preallocated buffer rather
+        # than growing an immutable string one page at a time
+        out = bytearray(len(fragments) * self.pageSz)
+        mv = memoryview(out)
+        for (i,f) in enumerate(fragments):
+            mv[i*self.pageSz:(i+1)*self.pageSz] = (self._empty_page
+                    if f is None else self.data[self.pageSlice(f)])
+        return bytes(out)
 
 """Parse a int encoded PKZip flags field into a dict of boolean flags
 
@@ -177,68 +458,101 @@ def parse_flags(flags):
                 'utf-8': bool(flags >> 11 & 1)
             }
 
-"""Parse a dos time and date to a python datetime"""
+"""Parse a dos time and date to a python datetime and the equivalent seconds
+since the epoch (treating it as UTC), or a pair of Nones if invalid.
+
+Archives tend to share a handful of timestamps between all their entries, so
+results are memoised.
+"""
+@functools.lru_cache(maxsize=65536)
 def parse_dos_datetime(t, d):
     year = (d >> 9 & 0x7f) + 1980
     month = d >> 5 & 0xf
     if month > 12:
-        return None
+        return (None, None)
     day = d & 0x1f # Already clamped to maxdays
     hour = (t>>11 & 0x1f)
     if hour > 23:
-        return None
+        return (None, None)
     minute = (t>>5 & 0x3f)
     if minute > 59:
-        return None
+        return (None, None)
     seconds = ((t & 0x1f)*2)
     if seconds > 59:
-        return None
-    return datetime.datetime(year,month,day,
-            hour=hour,
-            minute=minute,
-            second=seconds)
+        return (None, None)
+    return (datetime.datetime(year,month,day,
+                hour=hour,
+                minute=minute,
+                second=seconds),
+            calendar.timegm((year, month, day, hour, minute, seconds)))
+
+# Fixed-size portions of each header, little endian and unpacked in one call
+_LFH_STRUCT = struct.Struct("<IHHHHHIIIHH")
+_CDH_STRUCT = struct.Struct("<IHHHHHHIIIHHHHHII")
+_EOCD_STRUCT = struct.Struct("<IHHHHIIH")
+_DD_STRUCT = struct.Struct("<IIII")
+# ...and the offsets at which their variable length fields begin
+_LFH_SIZE = _LFH_STRUCT.size
+_CDH_SIZE = _CDH_STRUCT.size
+_EOCD_SIZE = _EOCD_STRUCT.size
+
+"""
+Build the clustering signature vectors for a list of headers column by column,
+as a matrix with one row per header: timestamp, compression method, any extra
+columns, then one column per ZFlags flag.
+
+:param method: getter for a header's ZMethod
+:param extra: getters for any further numeric columns, in order
+"""
+def sig_matrix(chunks, method, extra=()):
+    n = len(chunks)
+    cols = [np.fromiter((c.last_mod_epoch for c in chunks), dtype=np.float64,
+                count=n),
+            np.fromiter((method(c).value for c in chunks), dtype=np.float64,
+                count=n)]
+    cols += [np.fromiter((get(c) for c in chunks), dtype=np.float64, count=n)
+            for get in extra]
+    flags = np.fromiter((c.flags for c in chunks), dtype=np.uint32, count=n)
+    cols.append(((flags[:, None] & _ZFLAG_VALUES) > 0).astype(np.float64))
+    return np.column_stack(cols)
 
 class LFH(object):
     """
-    Parse an Local File Header from a given byte string slice
+    Parse an Local File Header from a given byte string slice or memoryview
     """
     @classmethod
     def from_data(cls, data):
         l = LFH()
-        if len(data) < 0x1d:
+        if len(data) < _LFH_SIZE:
             return None
-        sig = struct.unpack('I',data[:4])[0]
+        (sig, l.zVer, l.flags, method, l.last_mod_t, l.last_mod_d, l.crc32,
+                l.cSize, l.uSize, l.fnLen, l.cmtLen) = _LFH_STRUCT.unpack_from(data)
         if not sig == 0x04034b50:
             print("Sig not found")
             return None
-        l.zVer = struct.unpack('h',data[4:6])[0]
-        l.flags = ZFlags(struct.unpack('h',data[6:8])[0])
-        l.comp_method = ZMethod(struct.unpack('h',data[8:10])[0])
-        l.last_mod_t = struct.unpack('h',data[10:12])[0]
-        l.last_mod_d = struct.unpack('h',data[12:14])[0]
-        l.last_mod_datetime = parse_dos_datetime(l.last_mod_t, l.last_mod_d)
-        l.crc32 = struct.unpack('I',data[14:18])[0]
-        l.cSize = struct.unpack('I',data[18:22])[0]
-        l.uSize = struct.unpack('I',data[22:26])[0]
-        l.fnLen = struct.unpack('h',data[26:28])[0]
-        l.cmtLen = struct.unpack('h',data[28:30])[0]
-        l.fn = data[30:30+l.fnLen]
-        l.cmt = data[30+l.fnLen:30+l.fnLen+l.cmtLen]
+        l.comp_method = _ZMETHODS.get(method)
+        if l.comp_method is None:
+            raise ValueError("%r is not a valid ZMethod" % method)
+        (l.last_mod_datetime, l.last_mod_epoch) = \
+                parse_dos_datetime(l.last_mod_t, l.last_mod_d)
+        fn_end = _LFH_SIZE + l.fnLen
+        l.fn = bytes(data[_LFH_SIZE:fn_end])
+        l.cmt = bytes(data[fn_end:fn_end+l.cmtLen])
 
         return l
+
     """
-    Convert a Local File Header to a floating point vector signature
+    Build the signature vectors for a list of Local File Headers column by
+    column, as a matrix with one row per header
     """
-    def sig_vector(self):
-        return [
-                float(calendar.timegm(self.last_mod_datetime.utctimetuple())),
-                float(self.comp_method.value)] + \
-              [float(flag in self.flags) for flag in list(ZFlags)]
+    @classmethod
+    def sig_matrix(cls, chunks):
+        return sig_matrix(chunks, operator.attrgetter('comp_method'))
 
     def __str__(self):
-        s = ("LFH:{%s -- verNeeded: %r, method: %r, crc32: 0x%x, cSz: 0x%x, datetime: %s, ptr: 0x%x}" %
-                (self.fn, self.zVer, self.comp_method, self.crc32,self.cSize,
-                    self.last_mod_datetime, self.ptr))
+        s = ("LFH:{%s -- verNeeded: %r, method: %r, flags: %r, crc32: 0x%x, cSz: 0x%x, datetime: %s, ptr: 0x%x}" %
+                (self.fn, self.zVer, self.comp_method, ZFlags(self.flags),
+                    self.crc32,self.cSize, self.last_mod_datetime, self.ptr))
         return s
 
 """
@@ -252,41 +566,27 @@ class CDH(object):
     @classmethod
     def from_data(cls, data):
         c = CDH()
-        if len(data) < 0x2e:
+        if len(data) < _CDH_SIZE:
             print("Too short CD")
             return None
-        sig = struct.unpack('I',data[:4])[0]
+        (sig, c.z_ver, c.z_v_needed, c.flags, method, c.last_mod_t,
+                c.last_mod_d, c.crc32, c.c_sz, c.u_sz, c.fn_len, c.xf_len,
+                c.fc_len, c.dsk_start, c.int_attr, c.ext_attr,
+                c.lf_offset) = _CDH_STRUCT.unpack_from(data)
 
         if not sig == 0x02014b50:
             print("sig not found")
-            print sig
+            print(sig)
             return None
-        c.z_ver = struct.unpack('H',data[4:6])[0]
-        c.z_v_needed = struct.unpack('H',data[6:8])[0]
-        c.flags = struct.unpack('H',data[8:0xa])[0]
-        method = struct.unpack('H',data[0xa:0xc])[0]
-        if method in [zmeth.value for zmeth in ZMethod]:
-            c.method = ZMethod(method)
-        else:
-            c.method = None
-        c.last_mod_t = struct.unpack('H',data[0xc:0xe])[0]
-        c.last_mod_d = struct.unpack('H',data[0xe:0x10])[0]
-        c.last_mod_datetime = parse_dos_datetime(c.last_mod_t,c.last_mod_d)
-        c.crc32 = struct.unpack('I',data[0x10:0x14])[0]
-        c.c_sz = struct.unpack('I',data[0x14:0x18])[0]
-        c.u_sz = struct.unpack('I',data[0x18:0x1c])[0]
-        c.fn_len = struct.unpack('h',data[0x1c:0x1e])[0]
-        c.xf_len = struct.unpack('h',data[0x1e:0x20])[0]
-        c.fc_len = struct.unpack('h',data[0x20:0x22])[0]
-        c.dsk_start = struct.unpack('h',data[0x22:0x24])[0]
-        c.int_attr = struct.unpack('h',data[0x24:0x26])[0]
-        c.ext_attr = struct.unpack('I',data[0x26:0x2a])[0]
-        c.lf_offset = struct.unpack('I',data[0x2a:0x2e])[0]
-        c.fn = data[0x2e:0x2e+c.fn_len]
-        c.xf = data[0x2e + c.fn_len: 0x2e + c.fn_len + c.xf_len]
-        c.fc = data[0x2e + c.fn_len + c.xf_len: 0x2e + c.fn_len + c.xf_len +
-                c.fc_len]
-        c.len = 0x2e + c.fn_len + c.xf_len + c.fc_len
+        c.method = _ZMETHODS.get(method)
+        (c.last_mod_datetime, c.last_mod_epoch) = \
+                parse_dos_datetime(c.last_mod_t,c.last_mod_d)
+        fn_end = _CDH_SIZE + c.fn_len
+        xf_end = fn_end + c.xf_len
+        c.len = xf_end + c.fc_len
+        c.fn = bytes(data[_CDH_SIZE:fn_end])
+        c.xf = bytes(data[fn_end:xf_end])
+        c.fc = bytes(data[xf_end:c.len])
 
         return c
 
@@ -295,51 +595,37 @@ class CDH(object):
                 (self.z_ver, self.z_v_needed, self.c_sz, self.fn, self.lf_offset, self.flags, self.ptr))
 
     """
-    Convert a Central Directory Header to a floating point signature vector for
-    clustering.
+    Build the signature vectors for a list of Central Directory Headers
+    column by column, as a matrix with one row per header
     """
-    def sig_vector(self):
-        return [
-                float(calendar.timegm(self.last_mod_datetime.utctimetuple())),
-                float(self.method.value),
-                float(self.z_ver),
-                float(self.z_v_needed)] + \
-              [float(bool(flag.value & self.flags)) for flag in list(ZFlags)]
+    @classmethod
+    def sig_matrix(cls, chunks):
+        return sig_matrix(chunks, operator.attrgetter('method'),
+                [operator.attrgetter('z_ver'), operator.attrgetter('z_v_needed')])
 
     """
     Derive the corresponding Local File Header for a given Central Directory
     header
     """
     def to_LFH(self):
-        lfh = "PK\x03\x04"
-        lfh += struct.pack('H',self.z_v_needed)
-        lfh += struct.pack('H',self.flags)
-        lfh += struct.pack('H',self.method.value)
-        lfh += struct.pack('H',self.last_mod_t)
-        lfh += struct.pack('H',self.last_mod_d)
-        if ZFlags.DataDescriptor in ZFlags(self.flags):
-            lfh += "\0"*12
+        if self.flags & ZFlags.DataDescriptor.value:
             # We need to zero out all of the data descriptor fields
+            (crc32, c_sz, u_sz) = (0, 0, 0)
         else:
-            lfh += struct.pack('I',self.crc32)
-            lfh += struct.pack('I',self.c_sz)
-            lfh += struct.pack('I',self.u_sz)
-        lfh += struct.pack('h',self.fn_len)
-        lfh += struct.pack('h',self.fc_len)
-        lfh += self.fn
+            (crc32, c_sz, u_sz) = (self.crc32, self.c_sz, self.u_sz)
+        parts = [_LFH_STRUCT.pack(0x04034b50, self.z_v_needed, self.flags,
+                    self.method.value, self.last_mod_t, self.last_mod_d,
+                    crc32, c_sz, u_sz, self.fn_len, self.fc_len),
+                 self.fn]
 
-        return lfh
+        return b"".join(parts)
 
     """
     Derive the corresponding Data Descriptor chunk for a given Central directory
     Header
     """
     def to_DD(self):
-        dd = "PK\x07\x08"
-        dd += struct.pack('I',self.crc32)
-        dd += struct.pack('I',self.c_sz)
-        dd += struct.pack('I',self.u_sz)
-        return dd
+        return _DD_STRUCT.pack(0x08074b50, self.crc32, self.c_sz, self.u_sz)
 
 
 """
@@ -353,28 +639,23 @@ class zipFile(object):
         z = zipFile()
         # Minimum of 20 bytes needed consecutive to avoid risk of inter-page
         # splitting based corruption
-        if len(data) < 20:
+        # (plus the comment length, which must be present to be parsed at all)
+        if len(data) < _EOCD_SIZE:
             return None
-        sig = struct.unpack('I',data[:4])[0]
+        (sig, z.diskNo, z.diskNoForCD, z.diskEntries, z.totalEntries,
+                z.cdSize, z.cd_offset, z.cmtLength) = _EOCD_STRUCT.unpack_from(data)
         # check signature is valid or bail
         if not sig == 0x06054b50:
             print("sig not found")
             print(sig)
             return None
-        z.diskNo = struct.unpack('h',data[4:6])[0]
-        z.diskNoForCD = struct.unpack('h',data[6:8])[0]
-        z.diskEntries = struct.unpack('h',data[8:10])[0]
-        z.totalEntries = struct.unpack('h',data[10:12])[0]
 
         if not z.diskEntries == z.totalEntries:
             return None
 
-        # Should use this to validate guesses about recovered CD when full
-        z.cdSize = struct.unpack('I',data[12:16])[0]
-        z.cd_offset = struct.unpack('I',data[16:20])[0]
-        z.cmtLength = struct.unpack('h',data[20:22])[0]
-        z.comment = data[22:22+z.cmtLength]
-        z.tot_sz = z.cmtLength + 0x16 + z.cdSize + z.cd_offset
+        # Should use cdSize to validate guesses about recovered CD when full
+        z.comment = bytes(data[_EOCD_SIZE:_EOCD_SIZE+z.cmtLength])
+        z.tot_sz = z.cmtLength + _EOCD_SIZE + z.cdSize + z.cd_offset
         return z
 
     def __str__(self):
@@ -395,6 +676,79 @@ class zipFile(object):
     # may be used for validating predictions.
 
 
+"""
+Per-process state for reconstruct_zip. Each worker maps the dump itself and
+starts every zip file from the same snapshot of unclaimed pages.
+"""
+_worker = {}
+
+def _init_worker(path, pageSz, frag_present, CDHeaders, lfh_index):
+    _worker['fs'] = FragSys(path, pageSz)
+    _worker['fs'].CDHeaders = CDHeaders
+    _worker['frag_present'] = frag_present
+    _worker['lfh_index'] = lfh_index
+
+"""
+Place the CD and LFH pages for a single zip file.
+
+:param z: the zipFile, with its cdpages already assembled
+:return: the zip file's page list, a dict mapping zip page indices to the dump
+    pages claimed for them, its (offset, CDH) records and log lines to print
+:rtype: tuple
+"""
+def reconstruct_zip(z):
+    f = _worker['fs']
+    f.frag_present = _worker['frag_present'].copy()
+    lfh_index = _worker['lfh_index']
+    claims = {}
+    log = []
+
+    # CD records in this zip file's CD pages, in order, reading across any
+    # page boundaries they're split over
+    cds = f.cdsInPages(z.cdpages)
+
+    # index in new data structure of the first cdpage
+    cd_start_page = (z.start_offset + z.cd_offset) // f.pageSz
+
+    fragments = ([None] * cd_start_page) + z.cdpages
+
+    # Find the starting point in the page of the initial cd header
+    loc_cdoffs = cds[0][0] if cds else -1
+    LFpagecount = (z.cd_offset - loc_cdoffs) // f.pageSz
+
+    log.append("Number of of recovered CD chunks: %d" % len(cds))
+
+    for (_,cd) in cds:
+        # Iterate over all CDs
+        # Generate the corresponding LFH to look up where it was found
+        ptr = lfh_index.get(cd.to_LFH(), [])
+
+        if len(ptr) == 1:
+            # We want to avoid cases where we've got too many candidates.
+            # We can't trust them, so we only handle cases where 1 pointer
+            # is returned
+
+            (ptr,) = ptr
+
+            new_pg_idx = (cd.lf_offset + z.start_offset) // f.pageSz
+            page_idx = f.findPageIdxForPtr(ptr)
+
+            # Here's the meat of our solution
+            if page_idx is not None:
+                fragments[new_pg_idx] = f.takePage(page_idx)
+                claims[new_pg_idx] = page_idx
+            elif not (ptr // f.pageSz) in fragments:
+                log.append("Somehow this lost LF page: %d" % ptr)
+
+        if cd.flags & ZFlags.DataDescriptor.value:
+            dd = cd.to_DD()
+            # TODO: do some searching for data descriptor chunk and add
+            # the page in the right place if found and it doesn't exist
+            # yet in our zip file fragments list
+
+    return (fragments, claims, cds, log)
+
+
 # The current organisation of the main routine is purely exploring a proof of
 # concept for the existance of a viable reconstruction method.
 
@@ -404,24 +758,22 @@ class zipFile(object):
 if __name__=="__main__":
     path = sys.argv[1]
     if len(sys.argv) > 2:
-        pageSz = int(sys.argv,0)
+        pageSz = int(sys.argv[2],0)
     else:
         pageSz = 0x400           # Default to a kilobyte for page size
     f = FragSys(path,pageSz)
-    f.findEOCDs()
-    print "Found %d zip files (EOCD chunks)" % len(f.zipFiles)
+    f.findAll()
+    print("Found %d zip files (EOCD chunks)" % len(f.zipFiles))
     for i in f.zipFiles:
-        print "Header: %s" % i
-
-    f.findLFHs()
+        print("Header: %s" % i)
 
-    print "Found %d Local File Headers" % len(f.fileHeaders)
+    print("Found %d Local File Headers" % len(f.fileHeaders))
 
-    f.findCDs()
+    print("Found %d Central Directory headers" % len(f.CDHeaders))
 
-    print "Found %d Central Directory headers" % len(f.CDHeaders)
+    lfh_index = f.indexLFHs()
 
-    print "Using kmeans2 to match CD headers to %d distinct zip files" % len(f.zipFiles)
+    print("Using kmeans2 to match CD headers to %d distinct zip files" % len(f.zipFiles))
     # Classify known chunks by central directory "centroid"
     classified = f.classifyChunks(Chunk.CD)
 
@@ -430,36 +782,36 @@ if __name__=="__main__":
     # across page boundaries
 
     for i in range(len(classified)):
-        print "%d similar CD chunks for zip file %d" % (len(classified[i][0]),
-                (i+1))
+        print("%d similar CD chunks for zip file %d" % (len(classified[i][0]),
+                (i+1)))
+
+    # An LFH offset beyond every zip file's CD offset can't be genuine
+    max_cd_offset = max(z.cd_offset for z in f.zipFiles)
 
     for (chunklist,centroid) in classified:
-        print "Classifier Centroid:"
-        print centroid
-        print len(chunklist)
-        data = ""
-        # Get CD header correlating to lowest offset
+        print("Classifier Centroid:")
+        print(centroid)
+        print(len(chunklist))
+        # Walk CD headers from the lowest offset up
         pages = []
+        page_set = set() # Indices of pages in the above, for membership tests
         last = None
-        while len(chunklist) > 0:
-            chunk = min(chunklist, key=lambda c: c.lf_offset)
-            if all(chunk.lf_offset > z.cd_offset for z in f.zipFiles):
+        chunklist.sort(key=operator.attrgetter('lf_offset'))
+        for chunk in chunklist:
+            if chunk.lf_offset > max_cd_offset:
                 break
             last = chunk
-            page_idx = findPageIdxForPtr(f.fragments, chunk.ptr)
-            if page_idx:
-                pages.append(f.fragments[page_idx])
-                f.fragments.pop(page_idx)
+            page_idx = f.findPageIdxForPtr(chunk.ptr)
+            if page_idx is not None:
+                pages.append(f.takePage(page_idx))
+                page_set.add(page_idx)
             else:
-                page = findPageIdxForPtr(pages, chunk.ptr)
-                if not page:
-                    print "CD page lost somewhere? ptr: %d, fn: %s" % (chunk.ptr, chunk.fn)
-
-            chunklist.remove(chunk)
+                if not (chunk.ptr // f.pageSz) in page_set:
+                    print("CD page lost somewhere? ptr: %d, fn: %s" % (chunk.ptr, chunk.fn))
         lastpage = pages[-1]
 
         for z in f.zipFiles:
-            if findPageIdxForPtr([lastpage],z.ptr) <> None:
+            if z.ptr // f.pageSz == lastpage:
                 z.cdpages = pages
 
     # We need to re-parse the CD records for each and get an ordered list of
@@ -473,100 +825,95 @@ if __name__=="__main__":
     # pages remaining that to fill the appropriate gaps in our final zip
     # document.
 
-    for zip_idx,z in enumerate(f.zipFiles):
-        print("Dumping recovered CD record for zip file %d:" % zip_idx)
-
-        # Render cdpages to temporary file system in order to
-        # find, parse and use CD records
-        tf = FragSys(None, 0x400)
-        tf.data = "".join([f.data[p] for p in z.cdpages])
-
-        # index in new data structure of the first cdpage
-        cd_start_page = (z.start_offset + z.cd_offset) / f.pageSz
-
-        tf.fragments = ([None] * cd_start_page) + z.cdpages
-
-        # Find the starting point in the page of the initial cd header
-        loc_cdoffs = tf.data.find('PK\x01\x02')
-        LFpagecount = (z.cd_offset - loc_cdoffs) / f.pageSz
-
-        tf.findCDs()
-
-        print "Number of of recovered CD chunks: %d" % len(tf.CDHeaders)
-
-        for cd in tf.CDHeaders:
-            # Iterate over all CDs
-            # Generate the corresponding LFH to search the data for it
-            lfh = cd.to_LFH()
-            ptr = []
-            i = 0
-            while f.data[i:].find(lfh) <> -1:
-                p = f.data[i:].find(lfh)
-                i = p+1
-                ptr += [p]
-
-            if len(ptr) == 1:
-                # We want to avoid cases where we've got too many candidates.
-                # We can't trust them, so we only handle cases where 1 pointer
-                # is returned
-
-                (ptr,) = ptr
-
-                new_pg_idx = (cd.lf_offset + z.start_offset) / f.pageSz
-                page_idx = findPageIdxForPtr(f.fragments, ptr)
-
-                # Here's the meat of our solution
-                if page_idx:
-                    tf.fragments[new_pg_idx] = f.fragments[page_idx]
-                    f.fragments.pop(page_idx)
-                elif not findPageIdxForPtr(tf.fragments, ptr):
-                    print "Somehow this lost LF page: %d" % ptr
-
-            if ZFlags.DataDescriptor in ZFlags(cd.flags):
-                dd = cd.to_DD()
-                # TODO: do some searching for data descriptor chunk and add
-                # the page in the right place if found and it doesn't exist
-                # yet in our zip file fragments list
-
-        # TODO: For each incomplete CD, starting with the smallest ones, we
-        # should find missing pages.
-        # Strategies for this include:
-        # - Eliminating low-entropy pages
-        # - Possibly finding other ways to reduce possible missing pages?
-        # - Using CRC values to validate the missing pages
-        # - Shifting fragment onto temporary file fragments list each time
-        # removing from the outstanding fragment pool to reduce complexity of
-        # subsequent searches
-
-        tally = 0
-        emptychunks = [] # Build a running map of tuples (count, start_page)
-                         # indicating contiguously empty chunks, so we can
-                         # prioritise these by smallest first for solutions
-        for (idx,frag) in enumerate(tf.fragments):
-            if frag is None:
-                tally += 1
-            elif tally > 0:
-                print("Empty chunk, %d page%s long, at page %d" %
-                    (tally,
-                     "s" if tally > 1 else "",
-                     idx - tally))
-                emptychunks.append((tally, idx-tally))
-                tally = 0
-
-        emptychunks = sorted(emptychunks, key=lambda chunk: chunk[0])
-        for chunk in filter(lambda chunk: len(chunk) == 1, emptychunks):
-            # Find the last LFH in the page beforehand, and use the CRC32 value
-            # to hunt for the next data page.
-
-            # Alternatively, check if we have a boundary-trailing LFHeader, and
-            # use the recovered CD records to hunt for the missing piece.
-            pass
-
-        # Important to cut in from the zip start offset
-        filedata = f.renderFragList(tf.fragments)[z.start_offset:]
-        print "Percentage recovered %f" % (100.0*len(filter(lambda x: x <> None, tf.fragments))/len(tf.fragments))
-        m = md5()
-        m.update(filedata)
-        of_name = "recovered_" + m.hexdigest() + ".zip"
-        with open(of_name,'wb') as zip_out:
-            zip_out.write(filedata)
+    # Each zip file is reconstructed in its own worker process against the
+    # same snapshot of unclaimed pages; claims are then merged back in zip file
+    # order so the result doesn't depend on scheduling
+    workers = max(1, min(len(f.zipFiles), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+            initargs=(path, pageSz, f.frag_present, f.CDHeaders,
+                lfh_index)) as pool:
+        results = pool.map(reconstruct_zip, f.zipFiles)
+        for zip_idx,(z,(fragments,claims,cds,log)) in enumerate(zip(f.zipFiles, results)):
+            print("Dumping recovered CD record for zip file %d:" % zip_idx)
+            for line in log:
+                print(line)
+
+            for (new_pg_idx,page_idx) in sorted(claims.items()):
+                if f.frag_present[page_idx]:
+                    f.takePage(page_idx)
+                else:
+                    # An earlier zip file got to this page first
+                    fragments[new_pg_idx] = None
+                    print("LF page %d already claimed by another zip file" %
+                            page_idx)
+
+            # TODO: For each incomplete CD, starting with the smallest ones, we
+            # should find missing pages.
+            # Strategies for this include:
+            # - Eliminating low-entropy pages (f.candidatePages, which scores
+            #   the whole dump, so only call it once there's a gap to fill)
+            # - Possibly finding other ways to reduce possible missing pages?
+            # - Using CRC values to validate the missing pages (done below for
+            #   single pages within stored entries)
+            # - Shifting fragment onto temporary file fragments list each time
+            # removing from the outstanding fragment pool to reduce complexity of
+            # subsequent searches
+
+            tally = 0
+            emptychunks = [] # Build a running map of tuples (count, start_page)
+                             # indicating contiguously empty chunks, so we can
+                             # prioritise these by smallest first for solutions
+            for (idx,frag) in enumerate(fragments):
+                if frag is None:
+                    tally += 1
+                elif tally > 0:
+                    print("Empty chunk, %d page%s long, at page %d" %
+                        (tally,
+                         "s" if tally > 1 else "",
+                         idx - tally))
+                    emptychunks.append((tally, idx-tally))
+                    tally = 0
+
+            emptychunks = sorted(emptychunks, key=lambda chunk: chunk[0])
+            spans = None
+            for (count, gap) in filter(lambda chunk: chunk[0] == 1, emptychunks):
+                # Find the last LFH in the page beforehand, and use the CRC32 value
+                # to hunt for the next data page. Stored entries' CRCs cover the
+                # page data as is, so a page can be checked by combining CRCs
+                if spans is None:
+                    filedata = f.renderFragList(fragments)
+                    spans = f.storedSpans(filedata, z.start_offset, cds)
+                gap_start = gap * f.pageSz
+                gap_end = gap_start + f.pageSz
+                for (start, end, crc) in spans:
+                    if not (start <= gap_start and gap_end <= end):
+                        continue
+                    # Only the gap itself may be missing from the entry
+                    if any(fragments[idx] is None
+                            for idx in range(start // f.pageSz,
+                                (end-1) // f.pageSz + 1)
+                            if idx != gap):
+                        break
+                    after = filedata[gap_end:end]
+                    matches = f.pagesMatchingCRC(f.candidatePages(),
+                            crc32(filedata[start:gap_start]) & 0xffffffff,
+                            crc32(after) & 0xffffffff, len(after), crc)
+                    if len(matches) == 1:
+                        fragments[gap] = f.takePage(matches[0])
+                        spans = None # Re-render before checking other gaps
+                        print("Page %d matches the CRC32 for page %d" %
+                                (matches[0], gap))
+                    break
+
+                # Alternatively, check if we have a boundary-trailing LFHeader, and
+                # use the recovered CD records to hunt for the missing piece.
+
+            # Important to cut in from the zip start offset
+            filedata = f.renderFragList(fragments)[z.start_offset:]
+            print("Percentage recovered %f" % (100.0*sum(1 for x in fragments if x is not None)/len(fragments)))
+            # Only used for naming the output, so use a SIMD-friendly hash with
+            # the same 128 bit digest length as the MD5 names used previously
+            of_name = ("recovered_" + blake2b(filedata, digest_size=16).hexdigest() +
+                    ".zip")
+            with open(of_name,'wb') as zip_out:
+                zip_out.write(filedata)